@@ -2,8 +2,8 @@ import awswrangler as wr
 import datetime as dt
 import pandas as pd
 
-from bfsp_scraper.utils.general import download_sp_from_link
-from settings import boto3_session
+from bfsp_scraper.utils.general import construct_betfair_sp_download_url, download_many
+from bfsp_scraper.settings import boto3_session
 
 DATABASE = 'finish-time-predict'
 
@@ -20,6 +20,7 @@ df = wr.athena.read_sql_query(
 df['event_dt'] = df['event_dt'].apply(lambda x: x.date())
 df = df.drop_duplicates()
 
+jobs = []
 for country in ['gb', 'ire']:
     dates = list(set(df[df['country'] == country]['event_dt']))
     missing_dates = [d for d in dd if d not in dates]
@@ -28,12 +29,13 @@ for country in ['gb', 'ire']:
         this_month = str(date.month).zfill(2)
         this_day = str(date.day).zfill(2)
         for type in ['win', 'place']:
-            link = f"https://promo.betfair.com/betfairsp/prices/" \
-                   f"dwbfprices{'uk' if country == 'gb' else country}{type}{this_day}{this_month}{this_year}.csv"
-            download_sp_from_link(
+            link = construct_betfair_sp_download_url(country, type, date)
+            jobs.append(dict(
                 link=link, country=country, type=type,
                 day=this_day, month=this_month, year=this_year,
                 mode='append'
-            )
+            ))
+
+download_many(jobs)
 
 
@@ -1,32 +1,26 @@
 # Download all files from Betfair's website and uplpoad them to an S3 bucket
 
 import pandas as pd
-import time
 import os
 import datetime as dt
 
-from apscheduler.schedulers.background import BackgroundScheduler
 from calendar import monthrange
 
-from bfsp_scraper.utils.general import download_sp_from_link
-from bfsp_scraper.utils.s3_tools import list_files
-from bfsp_scraper.settings import boto3_session, S3_BUCKET
+from bfsp_scraper.utils.general import construct_betfair_sp_download_url, download_many
+from bfsp_scraper.utils.s3_tools import iter_keys
+from bfsp_scraper.settings import S3_BUCKET
 
 
-job_defaults = {
-    'coalesce': False,
-    'max_instances': 10
-}
-scheduler = BackgroundScheduler(job_defaults=job_defaults)
+# Set to True to rebuild the parquet datasets and Glue tables from scratch. Every date is then
+# downloaded again, and the first write for each market type overwrites its dataset and table
+refresh_tables = False
 
-files = list_files(bucket=S3_BUCKET, prefix='data', session=boto3_session)
-# Remove folder name from the list of returned objects
-if len(files) > 1:
-    files = files[1:]
-    file_names = [f.get('Key').split('data/')[1] for f in files
-                  if len(f.get('Key').split('data/')) > 1]
+# Names of the files already in S3, as a set so each date is checked in constant time
+if refresh_tables:
+    file_names = frozenset()
 else:
-    file_names = []
+    file_names = frozenset(key.split('data/', 1)[1] for key in iter_keys(prefix='data/', bucket=S3_BUCKET)
+                           if key.endswith('.parquet'))
 
 today = dt.datetime.today().date()
 this_year = today.year
@@ -40,38 +34,35 @@ for i in range(start_year, this_year+1):
 types = [x.lower() for x in os.environ['TYPES'].split(',')]
 countries = [x.lower() for x in os.environ['COUNTRIES'].split(',')]
 
-table_refreshed = True  # Set to false to refresh
+# Zero padded month and day strings, indexed by month or day number
+months_padded = tuple(f"{m:02d}" for m in range(13))
+days_padded = tuple(f"{d:02d}" for d in range(32))
+
+jobs = []
 for country in countries:
     temp_result2 = pd.DataFrame()
     for type in types:
         temp_result = pd.DataFrame()
         for year in years:
+            prefix = f"{type}{country}{year}"
             for month in range(1, 13):
+                month_padded = months_padded[month]
+                prefix_month = prefix + month_padded
                 days = monthrange(year, month)[1]
                 for day in range(1, days+1):
-                    if f"{type}{country}{year}{str(month).zfill(2)}{str(day).zfill(2)}.json" in file_names:
-                        print(f"{type}{country}{year}{month}{day} exists in S3, skipping")
+                    file_name = prefix_month + days_padded[day]
+                    if f"{file_name}.parquet" in file_names:
+                        print(f"{file_name} exists in S3, skipping")
                     else:
-                        if not dt.datetime(year=int(year), month=int(month), day=int(day)) > dt.datetime.today():
+                        file_date = dt.date(year, month, day)
+                        if not file_date > today:
                             print(f"{year}/{month}/{day}/{type}/{country}")
-                            day = str(day).zfill(2)
-                            month = str(month).zfill(2)
-                            year = year
-                            link = f"https://promo.betfair.com/betfairsp/prices/" \
-                                   f"dwbfprices{country}{type}{day}{month}{year}.csv"
-                            scheduler.add_job(func=download_sp_from_link, id=str(hash(link)), kwargs={
-                                'link': link, 'country': country, 'type': type,
-                                'day': day, 'month': month, 'year': year,
-                                'mode': 'overwrite' if not table_refreshed else 'append'},
-                                              misfire_grace_time=999999999)
-                            table_refreshed = True
+                            link = construct_betfair_sp_download_url(country, type, file_date)
+                            jobs.append(dict(
+                                link=link, country=country, type=type,
+                                day=days_padded[day], month=month_padded, year=year
+                            ))
 
-scheduler.start()
-time.sleep(1)
-print(f"Jobs left: {len(scheduler.get_jobs())}")
-time.sleep(1)
-while len(scheduler.get_jobs()) > 0:
-    print(f"Jobs left: {len(scheduler.get_jobs())}")
-    time.sleep(1)
-scheduler.shutdown()
+print(f"Downloading {len(jobs)} files")
+download_many(jobs, overwrite=refresh_tables)
 
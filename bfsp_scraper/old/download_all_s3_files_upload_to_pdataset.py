@@ -13,7 +13,7 @@ import pyarrow
 from apscheduler.schedulers.background import BackgroundScheduler
 
 from bfsp_scraper.settings import PROJECT_DIR, S3_BUCKET, AWS_GLUE_DB, \
-    AWS_GLUE_TABLE, SCHEMA_COLUMNS, AWS_SECRET_ACCESS_KEY, AWS_ACCESS_KEY_ID
+    AWS_GLUE_TABLE, SCHEMA_COLUMNS, SCHEMA_COLUMN_ORDER, AWS_SECRET_ACCESS_KEY, AWS_ACCESS_KEY_ID
 from bfsp_scraper.utils.s3_tools import download_from_s3
 
 
@@ -26,7 +26,7 @@ def append_to_pdataset(local_path, mode='a', index=False, header=False):
         df = pd.read_parquet(local_path)
         df['event_dt'] = pd.to_datetime(df['event_dt'])
         df['year'] = df['event_dt'].apply(lambda x: x.year)
-        df = df[list(SCHEMA_COLUMNS.keys())]
+        df = df[SCHEMA_COLUMN_ORDER]
         df.to_csv(df_all_dir, mode=mode, header=header, index=index)
     except pyarrow.lib.ArrowInvalid as e:
         print(f"Loading parquet file failed. \nFile path: {local_path}. \nError: {e}")
@@ -8,8 +8,8 @@ import argparse
 # Add the parent directory to the Python path
 sys.path.append(str(Path(__file__).parent.parent))
 
-from bfsp_scraper.utils.general import download_sp_from_link
-from settings import boto3_session
+from bfsp_scraper.utils.general import construct_betfair_sp_download_url, download_many
+from bfsp_scraper.settings import boto3_session
 
 DATABASE = 'finish-time-predict'
 
@@ -38,7 +38,7 @@ def delete_data_for_period(start_date, end_date, country, force=False):
             database=DATABASE,
             boto3_session=boto3_session
         )
-        if len(preview_df) > 0:
+        if not preview_df.empty:
             print(preview_df)
         else:
             print("No existing data found for this period")
@@ -88,28 +88,27 @@ def regenerate_data(race_start_date, race_end_date, country):
     d2 = pd.to_datetime(race_end_date)
     race_dates = [(d1 + dt.timedelta(days=x)).date() for x in range((d2-d1).days + 1)]
 
+    jobs = []
+
     for race_date in race_dates:
         # The file date is one day ahead of the race date
         file_date = race_date + dt.timedelta(days=1)
         
-        # Use file_date for constructing the URL
-        file_year = str(file_date.year)
-        file_month = str(file_date.month).zfill(2)
-        file_day = str(file_date.day).zfill(2)
-        
         # Use race_date for the data we're storing
         race_year = str(race_date.year)
         race_month = str(race_date.month).zfill(2)
         race_day = str(race_date.day).zfill(2)
         
         for type in ['win', 'place']:
-            link = f"https://promo.betfair.com/betfairsp/prices/" \
-                   f"dwbfprices{'uk' if country == 'gb' else country}{type}{file_day}{file_month}{file_year}.csv"
-            download_sp_from_link(
+            # Use file_date for constructing the URL
+            link = construct_betfair_sp_download_url(country, type, file_date)
+            jobs.append(dict(
                 link=link, country=country, type=type,
                 day=race_day, month=race_month, year=race_year,
                 mode='append'
-            )
+            ))
+
+    download_many(jobs)
 
 
 def main():
@@ -1,7 +1,11 @@
+import awswrangler as wr
 import boto3
 import pathlib
+import pyarrow as pa
 import bfsp_scraper
 
+from botocore.config import Config
+
 from bfsp_scraper.utils.config import get_attribute
 
 SCHEMA_COLUMNS = {
@@ -22,12 +26,25 @@ SCHEMA_COLUMNS = {
     'morningtradedvol': 'double',
     'pptradedvol': 'double',
     'iptradedvol': 'double',
-    'country': 'string',
-    'type': 'string',
     'selection_name_cleaned': 'string',
     'event_date': 'string',
+    'country': 'string',
+    'type': 'string',
     'year': 'int'
 }
+# The parquet datasets are partitioned by these, which are kept as the last columns of SCHEMA_COLUMNS
+PARTITION_COLS = ('country', 'type', 'year')
+
+# Derived once at import time so they aren't rebuilt for every file processed
+_ARROW_TYPES = {
+    'int': pa.int32(),
+    'double': pa.float64(),
+    'string': pa.string(),
+    'timestamp': pa.timestamp('ns'),
+    'boolean': pa.bool_()
+}
+SCHEMA_COLUMN_ORDER = list(SCHEMA_COLUMNS.keys())
+SCHEMA_ARROW = pa.schema([(name, _ARROW_TYPES[type]) for name, type in SCHEMA_COLUMNS.items()])
 
 PROJECT_DIR = str(pathlib.Path(bfsp_scraper.__file__).resolve().parent).replace('\\', '/')
 S3_BUCKET = get_attribute('S3_BUCKET')
@@ -38,3 +55,15 @@ TYPES = get_attribute('TYPES')
 COUNTRIES = get_attribute('COUNTRIES')
 
 boto3_session = boto3.Session(region_name='eu-west-1')
+
+
+# Shared by every client, including the ones awswrangler creates, so concurrent
+# calls aren't queued behind botocore's default pool of 10 connections. Uploads are
+# also retried by try_again, so botocore only gets a few attempts of its own
+BOTO_CONFIG = Config(
+    max_pool_connections=64,
+    retries={'mode': 'adaptive', 'max_attempts': 3},
+    tcp_keepalive=True
+)
+wr.config.botocore_config = BOTO_CONFIG
+S3_CLIENT = boto3_session.client('s3', config=BOTO_CONFIG)
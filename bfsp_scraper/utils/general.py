@@ -1,24 +1,60 @@
 import os
-import errno
 import time
 import io
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import awswrangler as wr
 import requests
 import random
 
-from bs4 import BeautifulSoup
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from requests.adapters import HTTPAdapter
+from pandas.api.types import union_categoricals
+from urllib3.util.retry import Retry
 
-from bfsp_scraper.settings import SCHEMA_COLUMNS, S3_BUCKET, AWS_GLUE_DB, boto3_session
+from bfsp_scraper.settings import (SCHEMA_COLUMNS, SCHEMA_COLUMN_ORDER, SCHEMA_ARROW, PARTITION_COLS, S3_BUCKET,
+                                   AWS_GLUE_DB, S3_CLIENT, boto3_session)
 
+# Number of files download_many has in flight at once
+_DOWNLOAD_WORKERS = 16
+# Seconds to wait for a connection and then for each read of the response
+_REQUEST_TIMEOUT = (5, 30)
 
-def clean_name(x, illegal_symbols="'$@#^(%*)._ ", append_with=None):
-    x = str(x).lower().strip()
-    while x[0].isdigit():
-        x = x[1:]
+# Reused for every request so connections to Betfair are kept alive between downloads, with
+# a pooled connection for each download worker. Connection errors and server errors are
+# retried with backoff by the adapter itself
+_RETRY = Retry(total=5, backoff_factor=1, status_forcelist=(500, 502, 503, 504),
+               allowed_methods=frozenset(['GET']), respect_retry_after_header=True)
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_maxsize=_DOWNLOAD_WORKERS, max_retries=_RETRY))
+
+# Column types for the Betfair csv files, whose headers are upper case until _store lowercases them
+_CSV_DTYPES = {'EVENT_ID': 'int64', 'SELECTION_ID': 'int64'}
+_CSV_DATE_FORMAT = '%d-%m-%Y %H:%M'
+
+ILLEGAL_SYMBOLS = "'$@#^(%*)._ "
+_CLEAN_TRANS = str.maketrans('', '', ILLEGAL_SYMBOLS)
+
+# Columns that _process derives rather than reading from the csv
+_DERIVED_COLUMNS = ('country', 'type', 'year', 'selection_name_cleaned', 'event_date')
+
+# Glue tables whose partition keys have been checked against the ones being appended
+_checked_tables = set()
+
+# Columns that hold a single value per file, kept as categoricals so batched data stays small in memory
+_CATEGORY_COLUMNS = ('country', 'type')
+
+
+def clean_name(x, illegal_symbols=ILLEGAL_SYMBOLS, append_with=None):
+    x = str(x).lower().strip().lstrip('0123456789')
     # Remove any symbols, including spaces
-    for s in illegal_symbols:
-        x = x.replace(s, "")
+    if illegal_symbols == ILLEGAL_SYMBOLS:
+        x = x.translate(_CLEAN_TRANS)
+    else:
+        x = x.translate(str.maketrans('', '', illegal_symbols))
     if append_with is not None:
         x = f"{x}_{append_with}"
     return x
@@ -27,14 +63,8 @@ def clean_name(x, illegal_symbols="'$@#^(%*)._ ", append_with=None):
 def mkdir_p(file_path):
     """Create a file path if one does not exist
     """
-    try:
-        os.makedirs(file_path)
-    except OSError as exc:  # Python >2.5
-        if exc.errno == errno.EEXIST and os.path.isdir(file_path):
-            pass
-        else:
-            print("OS error: {}".format(exc))
-            raise
+    if file_path:
+        os.makedirs(file_path, exist_ok=True)
 
 
 def safe_open(dir_path, type):
@@ -42,90 +72,297 @@ def safe_open(dir_path, type):
         Taken from https://stackoverflow.com/a/600612/119527
     """
     # Open "path" for writing, creating any parent directories as needed.
-    mkdir_p(os.path.dirname(dir_path))
+    parent = os.path.dirname(dir_path)
+    if parent:
+        mkdir_p(parent)
     return open(dir_path, type)
 
 
-def try_again(wait_seconds=1, retries=3):
-    """A decorator function that retries a function after a
-    number of seconds if it fails"""
+class PartitionMismatchError(Exception):
+    """Raised when appending to a Glue table that is partitioned differently to the data"""
+
+
+def try_again(base_delay=1.0, max_delay=30.0, retries=3, jitter=0.5):
+    """A decorator function that retries a function if it fails, waiting
+    exponentially longer between attempts with some random jitter added.
+    The error is raised if the last attempt fails too. A PartitionMismatchError
+    fails the same way every time, so it is raised straight away"""
     def decorator(func):
         def wrapper(*args, **kwargs):
-            try:
-                result = func(*args, **kwargs)
-                return result
-            except Exception as e:
-                print(f'{func.__name__} failed. retrying, error: ')
-                print(e)
-                for i in range(retries):
-                    try:
-                        time.sleep(wait_seconds)
-                        result = func(*args, **kwargs)
-                        return result
-                    except Exception as e:
-                        print(f'{func.__name__} failed. retrying, error: ')
-                        print(e)
-                        pass
+            for attempt in range(retries + 1):
+                try:
+                    return func(*args, **kwargs)
+                except Exception as e:
+                    if isinstance(e, PartitionMismatchError) or attempt == retries:
+                        raise
+                    print(f'{func.__name__} failed. retrying, error: ')
+                    print(e)
+                    delay = min(max_delay, base_delay * 2 ** attempt)
+                    time.sleep(delay * (1.0 + random.random() * jitter))
         return wrapper
     return decorator
 
 
+# The proxy list rarely changes, so it is only fetched again once it is older than this
+_PROXY_TTL_SECONDS = 600
+_proxy_cache = {'fetched_at': None, 'proxies': None}
+
+
 def fetch_uk_proxies():
+    fetched_at = _proxy_cache['fetched_at']
+    if fetched_at is not None and time.monotonic() - fetched_at < _PROXY_TTL_SECONDS:
+        return list(_proxy_cache['proxies'])
+
     url = 'https://free-proxy-list.net/uk-proxy.html'
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'}
 
-    response = requests.get(url, headers=headers)
-    soup = BeautifulSoup(response.text, 'html.parser')
+    response = _SESSION.get(url, headers=headers, timeout=_REQUEST_TIMEOUT)
 
     # Assuming the IP addresses are contained within a table
     # Note: The website structure might change, so this could need an update
-    table = soup.find('table', 'table table-striped table-bordered')
-    trs = table.find_all('tr')
-    ip_addresses = list()
-    for res in trs[1:]:
-        ip_address = res.next.next
-        port = res.next.next.next.next
-        ip_addresses.append(f"{ip_address}:{port}")
-    return ip_addresses
+    table = pd.read_html(io.StringIO(response.text), flavor='lxml',
+                         attrs={'class': 'table table-striped table-bordered'})[0]
+    table = table.dropna(subset=['IP Address', 'Port'])
+    proxies = (table['IP Address'].astype(str) + ':' + table['Port'].astype(int).astype(str)).tolist()
+    _proxy_cache.update(fetched_at=time.monotonic(), proxies=proxies)
+    return list(proxies)
 
 
-@try_again()
-def download_sp_from_link(link, country, type, day, month, year, mode='append', partition_cols=None):
+def _parquet_kwargs():
+    """Zstandard compressed parquet with large row groups and dictionary encoding.
+    Built fresh for every write as awswrangler modifies these in place"""
+    return {
+        'compression': 'zstd',
+        'pyarrow_additional_kwargs': {
+            'use_dictionary': True,
+            'data_page_size': 1024 * 1024,
+            'write_table_args': {'row_group_size': 1_000_000}
+        }
+    }
+
+
+def construct_betfair_sp_download_url(country_code, type_str, file_date):
+    """Build the link to Betfair's SP csv for a country, market type and file date"""
+    country = 'uk' if country_code.lower() == 'gb' else country_code.lower()
+    return f"https://promo.betfair.com/betfairsp/prices/dwbfprices{country}{type_str.lower()}{file_date:%d%m%Y}.csv"
+
+
+def _rows_per_file(df, target_bytes=16 * 1024 * 1024, sample_rows=10_000):
+    """Estimate how many rows fit in a parquet file of around target_bytes,
+    based on the encoded size of a sample of the dataframe. Frames no bigger
+    than the sample are written as a single file, so None is returned for them"""
+    if len(df) <= sample_rows:
+        return None
+    sample = pa.Table.from_pandas(df.head(sample_rows), preserve_index=False)
+    buffer = pa.BufferOutputStream()
+    pq.write_table(sample, buffer, compression=_parquet_kwargs()['compression'])
+    row_bytes = buffer.getvalue().size / max(sample.num_rows, 1)
+    return max(int(target_bytes / row_bytes), 1)
+
+
+def _fetch(link):
+    """Download a Betfair SP csv file and return its contents as a DataFrame,
+    or None if there is no file for the link"""
     print(f'Trying to download link: {link}')
-    df = pd.read_csv(link)
-    print(f"Success: {df}")
-
-    if len(df) > 0:
-        # Clean up data columns
-        df.columns = [col.lower() for col in list(df.columns)]
-        df['country'] = country
-        df['type'] = type
-        df['event_dt'] = pd.to_datetime(df['event_dt'], format="%d-%m-%Y %H:%M")
-        df['event_dt'] = pd.to_datetime(df['event_dt'].dt.strftime('%Y-%m-%d %H:%M'))
-        df['year'] = df['event_dt'].apply(lambda x: x.year)
-        # Change country UK to GB
-        df['country'] = df['country'].apply(lambda x: 'gb' if x.lower() == 'uk' else x)
-        df['selection_name_cleaned'] = df.apply(
-            lambda x: clean_name(x['selection_name'], append_with=x['country']), axis=1)
-        df['event_date'] = df['event_dt'].apply(lambda x: str(x.date()))
-        file_name = f"{type}{country}{year}{month}{day}"
-        # Upload the dataframe to S3 in parquet format
-        wr.s3.to_parquet(df, f"s3://{S3_BUCKET}/data/{file_name}.parquet", boto3_session=boto3_session)
-        # Upload the data to a dataset in S3 as well
-        print('Uploading data to parquet dataset')
-        table = f'betfair_{str(type).lower()}_prices'
-        wr.s3.to_parquet(
-            df, path=f's3://{S3_BUCKET}/{str(type).lower()}_price_datasets/',
-            dataset=True, database=AWS_GLUE_DB, table=table, dtype=SCHEMA_COLUMNS,
-            mode=mode, boto3_session=boto3_session, partition_cols=partition_cols
-        )
-        print('Uploading complete')
+    # Stream the body straight into the C parser rather than buffering it as a string first
+    with _SESSION.get(link, stream=True, timeout=_REQUEST_TIMEOUT) as response:
+        # Many dates have no file. Return without reading the body and without retrying
+        if response.status_code == 404:
+            print(f"No file found at {link}")
+            return None
+        response.raise_for_status()
+        response.raw.decode_content = True
+        df = pd.read_csv(response.raw, engine='c', dtype=_CSV_DTYPES,
+                         parse_dates=['EVENT_DT'], date_format=_CSV_DATE_FORMAT)
+    print(f"Success: {len(df)} rows from {link}")
+    return df
+
+
+def _process(df, country, type):
+    """Clean up the raw SP data into the columns of SCHEMA_COLUMNS. The columns are
+    collected in a dict so the output dataframe is only assembled once"""
+    df.columns = df.columns.str.lower()
+    cols = {col: df[col] for col in SCHEMA_COLUMN_ORDER if col not in _DERIVED_COLUMNS}
+    cols['event_dt'] = df['event_dt'].dt.floor('min')
+    # Change country UK to GB
+    cols['country'] = 'gb' if country.lower() == 'uk' else country.lower()
+    cols['type'] = type.lower()
+    cols['year'] = cols['event_dt'].dt.year.astype('int32')
+    cols['selection_name_cleaned'] = (
+        df['selection_name'].astype(str).str.lower().str.strip()
+        .str.lstrip('0123456789').str.translate(_CLEAN_TRANS)
+        + f"_{cols['country']}")
+    cols['event_date'] = cols['event_dt'].dt.strftime('%Y-%m-%d')
+    df = pd.DataFrame(cols, columns=SCHEMA_COLUMN_ORDER, copy=False)
+    return df.astype({col: 'category' for col in _CATEGORY_COLUMNS})
+
+
+def _check_partitions(table, partition_cols):
+    """Appending files partitioned one way to a table partitioned another way (or not at all)
+    succeeds, but leaves the partition columns unreadable. Refuse to until the table is overwritten"""
+    partition_cols = list(partition_cols or [])
+    if (table, *partition_cols) in _checked_tables:
+        return
+    if wr.catalog.does_table_exist(database=AWS_GLUE_DB, table=table, boto3_session=boto3_session):
+        columns = wr.catalog.table(database=AWS_GLUE_DB, table=table, boto3_session=boto3_session)
+        table_partitions = columns.loc[columns['Partition'], 'Column Name'].tolist()
+        if table_partitions != partition_cols:
+            raise PartitionMismatchError(f"{table} is partitioned by {table_partitions}, not {partition_cols}. "
+                                         f"Overwrite it with a full refresh before appending to it")
+    _checked_tables.add((table, *partition_cols))
+
+
+@try_again()
+def _write_dataset(df, type, mode='append', partition_cols=PARTITION_COLS):
+    """Upload SP data to the parquet dataset and Glue table for its market type"""
+    print('Uploading data to parquet dataset')
+    table = f'betfair_{str(type).lower()}_prices'
+    if mode == 'append':
+        _check_partitions(table, partition_cols)
+    wr.s3.to_parquet(
+        df, path=f's3://{S3_BUCKET}/{str(type).lower()}_price_datasets/',
+        dataset=True, database=AWS_GLUE_DB, table=table, dtype=SCHEMA_COLUMNS,
+        mode=mode, boto3_session=boto3_session,
+        partition_cols=list(partition_cols) if partition_cols else None,
+        max_rows_by_file=_rows_per_file(df), **_parquet_kwargs()
+    )
+    print('Uploading complete')
+
+
+@try_again()
+def _put_parquet(df, key):
+    """Upload SP data to S3 as a single parquet file with the table's column types,
+    encoded in memory and sent with the shared S3 client"""
+    table = pa.Table.from_pandas(df, schema=SCHEMA_ARROW, preserve_index=False)
+    kwargs = _parquet_kwargs()
+    options = kwargs['pyarrow_additional_kwargs']
+    buffer = pa.BufferOutputStream()
+    pq.write_table(table, buffer, compression=kwargs['compression'], use_dictionary=options['use_dictionary'],
+                   data_page_size=options['data_page_size'], **options['write_table_args'])
+    S3_CLIENT.put_object(Bucket=S3_BUCKET, Key=key, Body=buffer.getvalue().to_pybytes())
+
+
+def _file_key(type, country, year, month, day):
+    """S3 key of the single parquet file kept for each downloaded SP file"""
+    return f"data/{type}{country}{year}{month}{day}.parquet"
+
+
+def _store(df, type, key, mode='append', partition_cols=PARTITION_COLS):
+    """Upload processed SP data to the parquet dataset for its market type, and to S3 as a single
+    parquet file. The single file is written last, as its presence marks the day as done. Each
+    upload is retried on its own, so a failed single file never writes the data to the dataset twice"""
+    _write_dataset(df, type=type, mode=mode, partition_cols=partition_cols)
+    _put_parquet(df, key)
+
+
+def _flush_batch(frames, type, mode='append', partition_cols=PARTITION_COLS):
+    """Upload the data from several files to the parquet dataset in a single write"""
+    df = pd.concat(frames, ignore_index=True)
+    # concat only keeps categoricals whose categories match, so combine them explicitly
+    for col in _CATEGORY_COLUMNS:
+        df[col] = union_categoricals([frame[col] for frame in frames])
+    _write_dataset(df, type=type, mode=mode, partition_cols=partition_cols)
+
+
+def download_sp_from_link(link, country, type, day, month, year, mode='append', partition_cols=PARTITION_COLS,
+                          return_df=False):
+    """Download an SP file and upload it to S3. With return_df, nothing is uploaded and the
+    processed data is returned for the caller to upload instead"""
+    df = _fetch(link)
+    if df is None:
+        return
+    if not df.empty:
+        df = _process(df, country=country, type=type)
+        if return_df:
+            return df
+        _store(df, type=type, key=_file_key(type, country, year, month, day),
+               mode=mode, partition_cols=partition_cols)
     else:
         print('df returned no rows')
 
 
+def download_many(jobs, max_workers=_DOWNLOAD_WORKERS, batch_files=100, batch_rows=1_000_000, overwrite=False):
+    """Run download_sp_from_link for each dict of keyword arguments in jobs, with up to
+    max_workers downloads in flight at once and at most twice that many submitted ahead of
+    the one being written. The parquet datasets are written in batches of up to batch_files
+    files or batch_rows rows, and the single files for each day are uploaded on the pool once
+    their batch is in the dataset. With overwrite, the first successful write for each market
+    type replaces its dataset and table"""
+    # Files waiting to be written for each market type, as (key, frame) pairs, along with
+    # their mode and partitions
+    batches = {}
+    # Day files being uploaded for each market type. They are waited on before the next batch
+    # of the type is written, so at most one batch of them is held per type
+    puts = {}
+    # Market types whose dataset is still to be overwritten. A type is only removed once a
+    # write has succeeded, so missing dates or failed writes don't leave the old table in place
+    to_overwrite = {job['type'] for job in jobs} if overwrite else set()
+
+    def wait_for_puts(type):
+        for key, future in puts.pop(type, []):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Couldn't upload {key}. Error: {e}")
+
+    def flush(type):
+        files, mode, partition_cols = batches.pop(type)
+        wait_for_puts(type)
+        if type in to_overwrite:
+            mode = 'overwrite'
+        try:
+            _flush_batch([df for _, df in files], type=type, mode=mode, partition_cols=partition_cols)
+        except Exception as e:
+            print(f"Couldn't upload {len(files)} {type} files to the parquet dataset. Error: {e}")
+            return
+        to_overwrite.discard(type)
+        puts[type] = [(key, executor.submit(_put_parquet, df, key)) for key, df in files]
+
+    def download(job):
+        try:
+            return download_sp_from_link(**job, return_df=True)
+        except Exception as e:
+            print(f"Couldn't get data for link: {job['link']}. Error: {e}")
+
+    def submit(n):
+        for job in islice(remaining, n):
+            pending.append((job, executor.submit(download, job)))
+
+    remaining = iter(jobs)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            submit(max_workers * 2)
+            while pending:
+                job, future = pending.popleft()
+                df = future.result()
+                submit(1)
+                if df is None:
+                    continue
+                type = job['type']
+                write_args = (job.get('mode', 'append'), job.get('partition_cols', PARTITION_COLS))
+                # Keep writes in job order when the mode or partitioning changes
+                if type in batches and batches[type][1:] != write_args:
+                    flush(type)
+                files = batches.setdefault(type, ([], *write_args))[0]
+                files.append((_file_key(type, job['country'], job['year'], job['month'], job['day']), df))
+                if len(files) >= batch_files or sum(len(f) for _, f in files) >= batch_rows:
+                    flush(type)
+            for type in list(batches):
+                flush(type)
+            for type in list(puts):
+                wait_for_puts(type)
+        except BaseException:
+            # Drop the queued work so an interrupt only waits for what is already running
+            for _, future in pending:
+                future.cancel()
+            for type_puts in puts.values():
+                for _, future in type_puts:
+                    future.cancel()
+            raise
+
 if __name__ == '__main__':
     link = 'https://promo.betfair.com/betfairsp/prices/dwbfpricesukwin13112020.csv'
     download_sp_from_link(link=link, country='uk', type='win', day=13,
-                          month=11, year=2020, mode='append', partition_cols=None)
+                          month=11, year=2020, mode='append')
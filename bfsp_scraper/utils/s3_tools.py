@@ -1,9 +1,10 @@
 import logging
-import boto3
 from botocore.exceptions import ClientError
 
-# Create boto3 client to interact with S3
-s3_client = boto3.client('s3')
+from bfsp_scraper.settings import S3_CLIENT
+
+# Reuse the shared boto3 client to interact with S3
+s3_client = S3_CLIENT
 
 
 def delete_from_s3(s3_path, bucket="betfair-exchange-qemtek"):
@@ -94,3 +95,17 @@ def list_files(prefix, bucket, session=None):
     for file in get_all_s3_objects(s3_client=client, Bucket=bucket, Prefix=prefix):
         output.append(file)
     return output
+
+
+def iter_keys(prefix, bucket, session=None):
+    """Yield the keys of all objects under an S3 prefix, one page at a time
+        :param prefix: S3 path
+        :param bucket: S3 Bucket to use"""
+    if session is not None:
+        client = session.client('s3')
+    else:
+        client = s3_client
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for file in page.get('Contents', []):
+            yield file['Key']
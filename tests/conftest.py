@@ -0,0 +1,8 @@
+import os
+
+# bfsp_scraper.settings reads these when it is imported, so give the tests placeholder values
+os.environ.setdefault('S3_BUCKET', 'test-bucket')
+os.environ.setdefault('AWS_GLUE_DB', 'test-db')
+os.environ.setdefault('TYPES', 'win,place')
+os.environ.setdefault('COUNTRIES', 'uk,ire')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-1')
@@ -0,0 +1,383 @@
+import datetime as dt
+import io
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from bfsp_scraper.settings import SCHEMA_COLUMN_ORDER, SCHEMA_ARROW, PARTITION_COLS
+from bfsp_scraper.utils import general
+
+SAMPLE_CSV = """EVENT_ID,MENU_HINT,EVENT_NAME,EVENT_DT,SELECTION_ID,SELECTION_NAME,WIN_LOSE,BSP,PPWAP,MORNINGWAP,PPMAX,PPMIN,IPMAX,IPMIN,MORNINGTRADEDVOL,PPTRADEDVOL,IPTRADEDVOL
+230000001,GB / Kemp 13th Nov,1m Hcap,13-11-2020 12:35,12345678,1. Mister O'Neil (IRE),1,4.5,4.6,5.1,5.5,4.1,12,1.01,123.4,5000.5,2000.1
+230000001,GB / Kemp 13th Nov,1m Hcap,13-11-2020 12:35,23456789,Dr. Speed_ y,0,8.2,8.0,9.0,9.5,7.5,30,4.0,50.0,800.0,300.0
+230000002,GB / Kemp 13th Nov,6f Mdn,13-11-2020 13:05,34567890,12Angry Men,0,20.0,19.5,21.0,22.0,18.0,100,15.0,10.0,100.0,50.0
+"""
+
+
+def read_sample():
+    """Parse the sample csv the same way _fetch parses a download"""
+    return pd.read_csv(io.StringIO(SAMPLE_CSV), engine='c', dtype=general._CSV_DTYPES,
+                       parse_dates=['EVENT_DT'], date_format=general._CSV_DATE_FORMAT)
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(general.time, 'sleep', lambda seconds: None)
+
+
+def test_try_again_raises_after_last_retry(no_sleep):
+    """The last error is raised once every retry has failed"""
+    calls = []
+
+    @general.try_again(retries=3)
+    def fail():
+        calls.append(1)
+        raise RuntimeError('S3 is down')
+
+    with pytest.raises(RuntimeError, match='S3 is down'):
+        fail()
+    assert len(calls) == 4
+
+
+def test_try_again_returns_once_a_retry_succeeds(no_sleep):
+    calls = []
+
+    @general.try_again(retries=3)
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise RuntimeError('S3 is down')
+        return 'done'
+
+    assert flaky() == 'done'
+    assert len(calls) == 3
+
+
+def test_try_again_does_not_retry_partition_mismatches(no_sleep):
+    calls = []
+
+    @general.try_again(retries=3)
+    def wrong_partitions():
+        calls.append(1)
+        raise general.PartitionMismatchError('wrong partitions')
+
+    with pytest.raises(general.PartitionMismatchError):
+        wrong_partitions()
+    assert len(calls) == 1
+
+
+def test_try_again_retries_other_value_errors(no_sleep):
+    calls = []
+
+    @general.try_again(retries=3)
+    def bad_response():
+        calls.append(1)
+        raise ValueError('truncated response')
+
+    with pytest.raises(ValueError):
+        bad_response()
+    assert len(calls) == 4
+
+
+def test_construct_betfair_sp_download_url_maps_gb_to_uk():
+    url = general.construct_betfair_sp_download_url('GB', 'WIN', dt.date(2020, 11, 3))
+    assert url == 'https://promo.betfair.com/betfairsp/prices/dwbfpricesukwin03112020.csv'
+    url = general.construct_betfair_sp_download_url('ire', 'place', dt.date(2020, 1, 13))
+    assert url == 'https://promo.betfair.com/betfairsp/prices/dwbfpricesireplace13012020.csv'
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=''):
+        self.status_code = status_code
+        self.raw = io.BytesIO(body.encode())
+        self.text = body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise general.requests.HTTPError(f'{self.status_code} error')
+
+
+@pytest.fixture
+def responses(monkeypatch):
+    """Serve FakeResponses from the shared session, recording the urls requested"""
+    requested = []
+    queue = []
+
+    def get(url, **kwargs):
+        requested.append(url)
+        return queue.pop(0)
+
+    monkeypatch.setattr(general._SESSION, 'get', get)
+    return queue, requested
+
+
+def test_fetch_returns_none_for_missing_files(responses):
+    queue, requested = responses
+    response = FakeResponse(404, SAMPLE_CSV)
+    queue.append(response)
+    assert general._fetch('https://promo.betfair.com/missing.csv') is None
+    assert requested == ['https://promo.betfair.com/missing.csv']
+    # The body of a missing file is never read
+    assert response.raw.tell() == 0
+
+
+def test_fetch_raises_for_other_errors(responses):
+    queue, _ = responses
+    queue.append(FakeResponse(500))
+    with pytest.raises(general.requests.HTTPError):
+        general._fetch('https://promo.betfair.com/error.csv')
+
+
+def test_fetch_parses_the_csv(responses):
+    queue, _ = responses
+    queue.append(FakeResponse(200, SAMPLE_CSV))
+    pd.testing.assert_frame_equal(general._fetch('https://promo.betfair.com/file.csv'), read_sample())
+
+
+PROXY_HTML = """<html><body>
+<table class="table"><tr><th>Updated</th></tr><tr><td>1 minute ago</td></tr></table>
+<table class="table table-striped table-bordered">
+<thead><tr><th>IP Address</th><th>Port</th><th>Code</th></tr></thead>
+<tbody>
+<tr><td>1.2.3.4</td><td>8080</td><td>GB</td></tr>
+<tr><td>5.6.7.8</td><td>3128</td><td>GB</td></tr>
+<tr><td></td><td></td><td></td></tr>
+</tbody>
+</table>
+</body></html>"""
+
+
+@pytest.fixture
+def proxy_page(responses, monkeypatch):
+    monkeypatch.setattr(general, '_proxy_cache', {'fetched_at': None, 'proxies': None})
+    queue, requested = responses
+    return queue, requested
+
+
+def test_fetch_uk_proxies_reads_the_proxy_table(proxy_page):
+    queue, requested = proxy_page
+    queue.append(FakeResponse(200, PROXY_HTML))
+    assert general.fetch_uk_proxies() == ['1.2.3.4:8080', '5.6.7.8:3128']
+    assert requested == ['https://free-proxy-list.net/uk-proxy.html']
+
+
+def test_fetch_uk_proxies_caches_the_list(proxy_page, monkeypatch):
+    queue, requested = proxy_page
+    now = [1000.0]
+    monkeypatch.setattr(general.time, 'monotonic', lambda: now[0])
+    queue.append(FakeResponse(200, PROXY_HTML))
+    proxies = general.fetch_uk_proxies()
+    # Changing the returned list doesn't change the cached one
+    proxies.pop()
+    now[0] += general._PROXY_TTL_SECONDS - 1
+    assert general.fetch_uk_proxies() == ['1.2.3.4:8080', '5.6.7.8:3128']
+    assert len(requested) == 1
+    now[0] += 1
+    queue.append(FakeResponse(200, PROXY_HTML.replace('8080', '8081')))
+    assert general.fetch_uk_proxies() == ['1.2.3.4:8081', '5.6.7.8:3128']
+    assert len(requested) == 2
+
+
+def test_process_output_columns_and_types():
+    df = general._process(read_sample(), country='uk', type='WIN')
+    assert list(df.columns) == SCHEMA_COLUMN_ORDER
+    assert list(df.columns[-len(PARTITION_COLS):]) == list(PARTITION_COLS)
+    assert df['country'].tolist() == ['gb'] * 3
+    assert df['type'].tolist() == ['win'] * 3
+    assert isinstance(df['country'].dtype, pd.CategoricalDtype)
+    assert isinstance(df['type'].dtype, pd.CategoricalDtype)
+    assert df['year'].dtype == 'int32'
+    assert df['year'].tolist() == [2020] * 3
+    assert df['event_id'].dtype == 'int64'
+    assert df['event_dt'].tolist() == [pd.Timestamp('2020-11-13 12:35')] * 2 + [pd.Timestamp('2020-11-13 13:05')]
+    assert df['event_date'].tolist() == ['2020-11-13'] * 3
+    assert df['selection_name_cleaned'].tolist() == ['misteroneilire_gb', 'drspeedy_gb', 'angrymen_gb']
+    assert df['selection_name_cleaned'].tolist() == [
+        general.clean_name(name, append_with='gb') for name in read_sample()['SELECTION_NAME']]
+
+
+def job(type, day, country='uk', **kwargs):
+    return dict(link=f'{type}{country}{day}', country=country, type=type, day=day, month='01', year=2020, **kwargs)
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    """Replace the downloads and uploads in download_many, recording the uploads in order"""
+    events = []
+    frames = {}
+
+    def download_sp_from_link(link, country, type, return_df, **kwargs):
+        frames[link] = general._process(read_sample(), country=country, type=type)
+        return frames[link]
+
+    def write_dataset(df, type, mode='append', partition_cols=PARTITION_COLS):
+        events.append(('dataset', type, mode, len(df)))
+        return []
+
+    monkeypatch.setattr(general, 'download_sp_from_link', download_sp_from_link)
+    monkeypatch.setattr(general, '_write_dataset', write_dataset)
+    monkeypatch.setattr(general, '_put_parquet', lambda df, key: events.append(('file', key)))
+    return events
+
+
+def test_download_many_uploads_day_files_after_their_batch(uploads):
+    general.download_many([job('win', '01'), job('win', '02'), job('win', '03')], max_workers=2, batch_files=2)
+    # The day files upload on the pool, so only their batch fixes their order
+    assert uploads[0] == ('dataset', 'win', 'append', 6)
+    assert set(uploads[1:3]) == {('file', 'data/winuk20200101.parquet'), ('file', 'data/winuk20200102.parquet')}
+    assert uploads[3:] == [
+        ('dataset', 'win', 'append', 3),
+        ('file', 'data/winuk20200103.parquet'),
+    ]
+
+
+def test_download_many_bounds_the_downloads_submitted_ahead(uploads, monkeypatch):
+    started = []
+    started_at_write = []
+
+    def download_sp_from_link(link, country, type, return_df, **kwargs):
+        started.append(link)
+        if link == 'winuk01':
+            # Hold up the first download so nothing is written while the others could run ahead
+            time.sleep(0.2)
+        return general._process(read_sample(), country=country, type=type)
+
+    def write_dataset(df, type, **kwargs):
+        started_at_write.append(len(started))
+        return []
+
+    monkeypatch.setattr(general, 'download_sp_from_link', download_sp_from_link)
+    monkeypatch.setattr(general, '_write_dataset', write_dataset)
+    general.download_many([job('win', f'{day:02}') for day in range(1, 41)], max_workers=2, batch_files=1)
+    assert len(started_at_write) == 40
+    # The nth write comes after the nth download is taken, which tops the window up to n + 4
+    assert all(count <= n + 4 for n, count in enumerate(started_at_write, start=1))
+
+
+def test_download_many_skips_day_files_when_the_batch_fails(uploads, monkeypatch, no_sleep):
+    def write_dataset(df, type, **kwargs):
+        uploads.append(('dataset', type))
+        if type == 'place':
+            raise RuntimeError('Glue is down')
+        return []
+
+    monkeypatch.setattr(general, '_write_dataset', write_dataset)
+    general.download_many([job('place', '01'), job('win', '01')])
+    assert uploads == [
+        ('dataset', 'place'),
+        ('dataset', 'win'),
+        ('file', 'data/winuk20200101.parquet'),
+    ]
+
+
+def test_download_many_flushes_when_the_mode_changes(uploads):
+    general.download_many([job('win', '01', mode='overwrite'), job('win', '02'), job('win', '03')])
+    assert [event for event in uploads if event[0] == 'dataset'] == [
+        ('dataset', 'win', 'overwrite', 3),
+        ('dataset', 'win', 'append', 6),
+    ]
+
+
+def test_download_many_overwrites_each_type_once(uploads, monkeypatch, no_sleep):
+    failed = []
+
+    def write_dataset(df, type, mode='append', partition_cols=PARTITION_COLS):
+        # The first place write fails, so the overwrite has to carry over to its next batch
+        if type == 'place' and not failed:
+            failed.append(mode)
+            raise RuntimeError('Glue is down')
+        uploads.append(('dataset', type, mode))
+        return []
+
+    monkeypatch.setattr(general, '_write_dataset', write_dataset)
+    jobs = [job(type, day) for day in ('01', '02') for type in ('win', 'place')]
+    general.download_many(jobs, batch_files=1, overwrite=True)
+    assert failed == ['overwrite']
+    assert [event for event in uploads if event[0] == 'dataset'] == [
+        ('dataset', 'win', 'overwrite'),
+        ('dataset', 'win', 'append'),
+        ('dataset', 'place', 'overwrite'),
+    ]
+
+
+@pytest.fixture
+def glue_tables(monkeypatch):
+    """Stand in for the Glue catalog with a dict of table name to partition columns,
+    recording every lookup"""
+    tables = {}
+    lookups = []
+
+    def does_table_exist(database, table, **kwargs):
+        lookups.append(table)
+        return table in tables
+
+    def table(database, table, **kwargs):
+        partitions = tables[table]
+        columns = ['event_id', *partitions]
+        return pd.DataFrame({'Column Name': columns, 'Partition': [name in partitions for name in columns]})
+
+    monkeypatch.setattr(general.wr.catalog, 'does_table_exist', does_table_exist)
+    monkeypatch.setattr(general.wr.catalog, 'table', table)
+    monkeypatch.setattr(general, '_checked_tables', set())
+    return tables, lookups
+
+
+def test_check_partitions_refuses_a_differently_partitioned_table(glue_tables):
+    tables, _ = glue_tables
+    tables['win'] = []
+    with pytest.raises(general.PartitionMismatchError):
+        general._check_partitions('win', PARTITION_COLS)
+    tables['place'] = ['country', 'year']
+    with pytest.raises(general.PartitionMismatchError):
+        general._check_partitions('place', PARTITION_COLS)
+
+
+def test_check_partitions_allows_matching_and_missing_tables(glue_tables):
+    tables, lookups = glue_tables
+    tables['win'] = list(PARTITION_COLS)
+    general._check_partitions('win', PARTITION_COLS)
+    general._check_partitions('place', PARTITION_COLS)
+    # Each table and partitioning is only looked up once
+    general._check_partitions('win', PARTITION_COLS)
+    assert lookups == ['win', 'place']
+    # A new partitioning for a checked table is looked up again
+    with pytest.raises(general.PartitionMismatchError):
+        general._check_partitions('win', None)
+
+
+def test_put_parquet_writes_the_table_schema(monkeypatch):
+    bodies = {}
+
+    def put_object(Bucket, Key, Body):
+        bodies[Key] = Body
+
+    monkeypatch.setattr(general.S3_CLIENT, 'put_object', put_object)
+    df = general._process(read_sample(), country='uk', type='win')
+    general._put_parquet(df, 'data/winuk20201113.parquet')
+    body = bodies['data/winuk20201113.parquet']
+    table = pq.read_table(pa.BufferReader(body))
+    assert table.schema.equals(SCHEMA_ARROW)
+    # The ids are int64 in pandas but int32 in the table, and the categories are plain strings
+    assert table.schema.field('event_id').type == pa.int32()
+    assert table.schema.field('country').type == pa.string()
+    assert table.column('selection_id').to_pylist() == [12345678, 23456789, 34567890]
+    metadata = pq.ParquetFile(pa.BufferReader(body)).metadata
+    assert metadata.row_group(0).column(0).compression == 'ZSTD'
+
+
+def test_rows_per_file_only_splits_large_frames():
+    df = general._process(read_sample(), country='uk', type='win')
+    assert general._rows_per_file(df) is None
+    large = pd.concat([df] * 5_000, ignore_index=True)
+    assert general._rows_per_file(large, sample_rows=1_000) > len(large)
+    rows = general._rows_per_file(large, target_bytes=100_000, sample_rows=1_000)
+    assert 1 <= rows < len(large)